@@ -1,22 +1,62 @@
 import os
-from typing import TypedDict, List, Optional
+import asyncio
+import atexit
+import functools
+import hashlib
+import itertools
+import json
+import sqlite3
+import ssl
+import time
+from contextlib import closing
+from urllib.parse import quote
+import operator
+from dataclasses import dataclass, field
+from typing import Annotated, List, Optional, Tuple
 from langgraph.graph import StateGraph, END
+from langchain_core.runnables import RunnableConfig
 from langchain_google_genai import ChatGoogleGenerativeAI
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+import google.auth.transport.requests
 from dotenv import load_dotenv
-import requests
+import aiohttp
+import certifi
+import orjson
 import logging
-import time  # Added for retry delays
+import logging.handlers
+import queue
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential
+)
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
+# Optional: semantic caption cache (pip install faiss-cpu sentence-transformers)
+try:
+    import faiss
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    faiss = None
 
-# Load environment variables from .env file
+# Load environment variables from .env file (before logging, so LOG_LEVEL can come from .env)
 load_dotenv()
 
+# Set up logging; records are queued and written by a background thread so rows never block on stdout
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+log_level = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())  # LOG_LEVEL=DEBUG for per-row details
+logging.basicConfig(
+    level=log_level if isinstance(log_level, int) else logging.INFO,  # Unknown names fall back to INFO
+    format='%(message)s',  # Full format is applied by log_stream_handler
+    handlers=[logging.handlers.QueueHandler(log_queue)]
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
+
 # Configuration
 GOOGLE_CREDENTIALS_PATH = os.getenv("GOOGLE_CREDENTIALS_PATH")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -26,6 +66,7 @@ INSTAGRAM_ACCOUNT_ID = os.getenv("INSTAGRAM_ACCOUNT_ID")
 INSTAGRAM_ACCESS_TOKEN = os.getenv("INSTAGRAM_ACCESS_TOKEN")
 FACEBOOK_PAGE_ID = os.getenv("FACEBOOK_PAGE_ID")
 FACEBOOK_ACCESS_TOKEN = os.getenv("FACEBOOK_ACCESS_TOKEN")
+POST_TO_FACEBOOK = os.getenv("POST_TO_FACEBOOK", "false").lower() == "true"  # Instagram only by default
 
 # Validate that all required environment variables are set
 required_vars = [
@@ -40,475 +81,644 @@ required_vars = [
 ]
 missing_vars = [var for var in required_vars if not os.getenv(var)]
 if missing_vars:
-    logger.error(f"Missing required environment variables: {', '.join(missing_vars)}")
+    logger.error("Missing required environment variables: %s", ', '.join(missing_vars))
     raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
 
+# Graph API auth headers, built once instead of sending access_token in every request body
+INSTAGRAM_HEADERS = {"Authorization": f"Bearer {INSTAGRAM_ACCESS_TOKEN}"}
+FACEBOOK_HEADERS = {"Authorization": f"Bearer {FACEBOOK_ACCESS_TOKEN}"}
+
+# Sheet columns holding the image prompt (A) and image URL (B)
+PROMPT_COL, IMAGE_URL_COL = 0, 1
+
+# Gemini client, shared by every row
+LLM = ChatGoogleGenerativeAI(
+    model="gemini-2.5-flash",
+    google_api_key=GEMINI_API_KEY
+)
+
+# Gemini prompt templates, filled in per row with .format(prompt=...)
+NORMALIZE_PROMPT_TEMPLATE = (
+    "Detect the language of the following text. "
+    "If it is not English, translate it into natural English. "
+    "Return ONLY the English version of the text.\n\n"
+    "Text:\n{prompt}"
+)
+CAPTION_PROMPT_TEMPLATE = (
+    "Create a single Instagram caption (max 150 words) for an AI-generated image.\n\n"
+    "Rules:\n"
+    "- The caption should feel modern, creative, and AI-art focused\n"
+    "- Include relevant trending hashtags\n"
+    "- Do NOT provide multiple options\n"
+    "- After the caption, add a new line exactly in this format:\n"
+    'Prompt for generating this image: "<PROMPT>"\n\n'
+    'Use this prompt:\n"{prompt}"'
+)
+
+# Concurrency limits: rows processed at once, and Instagram calls in flight (avoids 429s)
+MAX_CONCURRENT_ROWS = 10
+instagram_semaphore = asyncio.Semaphore(3)
+
+# HTTP connection pool, timeouts and transport-level retries for Graph and Sheets API calls
+HTTP_POOL_SIZE = 20
+HTTP_POOL_SIZE_PER_HOST = 10
+HTTP_TIMEOUT = aiohttp.ClientTimeout(sock_connect=5, sock_read=30)
+SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())  # CA bundle parsed once
+HTTP_RETRY_STATUSES = {429, 500, 502, 503}
+HTTP_MAX_ATTEMPTS = 5
+
+
+# ClientResponseError that keeps the response body, where Google and Graph API explain the failure
+class HTTPResponseError(aiohttp.ClientResponseError):
+    def __init__(self, response: aiohttp.ClientResponse, body: str):
+        super().__init__(
+            response.request_info, response.history,
+            status=response.status, message=f"{response.reason}. Response: {body}", headers=response.headers
+        )
+        self.body = body
+
+
+# Like response.raise_for_status(), but the error carries the buffered response body
+def raise_for_status(response: aiohttp.ClientResponse, body: bytes):
+    if response.status >= 400:
+        raise HTTPResponseError(response, body.decode("utf-8", errors="replace"))
+
+
+# Idempotent requests: retry rate limits, server errors, timeouts and dropped connections
+def is_retryable_error(e: BaseException) -> bool:
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status in HTTP_RETRY_STATUSES
+    return isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
 
-# Initialize Google Sheets API client
-def get_sheets_service():
-    logger.info("Initializing Google Sheets API client")
+# Non-idempotent requests: only retry when the server cannot have acted on the request
+def is_retryable_before_send_error(e: BaseException) -> bool:
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status == 429
+    return isinstance(e, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError))
+
+
+# HTTP request with jittered exponential backoff, so concurrent rows don't retry in lockstep.
+# POSTs are treated as non-idempotent unless the caller passes idempotent=True.
+# Returns (response, body): the response is released on return, so parse the buffered body, not response.read().
+async def request_with_retry(
+    session: aiohttp.ClientSession, method: str, url: str, idempotent: Optional[bool] = None, **kwargs
+) -> Tuple[aiohttp.ClientResponse, bytes]:
+    if idempotent is None:
+        idempotent = method != "POST"
+
+    def log_retry(retry_state):
+        logger.warning(
+            "Retry attempt %s/%s for %s %s after error: %s",
+            retry_state.attempt_number, HTTP_MAX_ATTEMPTS, method, url, retry_state.outcome.exception()
+        )
+
+    retrying = AsyncRetrying(
+        stop=stop_after_attempt(HTTP_MAX_ATTEMPTS),
+        wait=wait_random_exponential(multiplier=1, max=30),
+        retry=retry_if_exception(is_retryable_error if idempotent else is_retryable_before_send_error),
+        before_sleep=log_retry,
+        reraise=True
+    )
+    async for attempt in retrying:
+        with attempt:
+            async with session.request(method, url, **kwargs) as response:
+                body = await response.read()
+            if response.status in HTTP_RETRY_STATUSES:
+                raise_for_status(response, body)  # Body survives into the error if retries run out
+    return response, body
+
+
+# Google Sheets REST API, called directly over the shared aiohttp session
+SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+
+
+# Load service account credentials (read once and reused for the whole run)
+@functools.lru_cache(maxsize=1)
+def get_sheets_credentials() -> Credentials:
+    logger.info("Loading Google service account credentials")
     try:
         creds = Credentials.from_service_account_file(
             GOOGLE_CREDENTIALS_PATH,
             scopes=["https://www.googleapis.com/auth/spreadsheets"]
         )
-        service = build("sheets", "v4", credentials=creds)
-        logger.info("Google Sheets API client initialized")
-        return service
+        logger.info("Google service account credentials loaded")
+        return creds
     except Exception as e:
-        logger.error(f"Failed to initialize Google Sheets API client: {str(e)}")
+        logger.error("Failed to load Google service account credentials: %s", e)
         raise
 
-# State definition for LangGraph
-class WorkflowState(TypedDict):
-    rows: List[dict]
-    current_row_index: int
-    caption: Optional[str]
-    post_id: Optional[str]
-    facebook_post_id: Optional[str]
-    error: Optional[str]
+
+# Authorization header for Sheets calls; refreshes the access token shortly before it expires
+async def get_sheets_headers() -> dict:
+    creds = get_sheets_credentials()
+    if not creds.valid:  # Also false within google-auth's refresh threshold of expiry
+        logger.info("Refreshing Google Sheets access token")
+        await asyncio.to_thread(creds.refresh, google.auth.transport.requests.Request())
+    return {"Authorization": f"Bearer {creds.token}"}
+
+
+# Exact caption cache: identical prompts (e.g. re-runs of rows that failed to clear) never hit Gemini again
+CAPTION_CACHE_DB_PATH = "caption_cache.db"
+
+
+def caption_cache_connection() -> sqlite3.Connection:
+    connection = sqlite3.connect(CAPTION_CACHE_DB_PATH, isolation_level=None)  # Autocommit
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS captions (prompt_hash TEXT PRIMARY KEY, caption TEXT, ts INTEGER)"
+    )
+    return connection
+
+
+def get_exact_cached_caption(prompt_hash: str) -> Optional[str]:
+    try:
+        with closing(caption_cache_connection()) as connection:
+            row = connection.execute(
+                "SELECT caption FROM captions WHERE prompt_hash = ?", (prompt_hash,)
+            ).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        logger.warning("Exact caption cache lookup failed: %s", e)
+        return None
+
+
+def store_exact_cached_caption(prompt_hash: str, caption: str):
+    try:
+        with closing(caption_cache_connection()) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO captions (prompt_hash, caption, ts) VALUES (?, ?, ?)",
+                (prompt_hash, caption, int(time.time()))
+            )
+    except sqlite3.Error as e:
+        logger.warning("Failed to update exact caption cache: %s", e)
+
+# Semantic caption cache: reuse the caption of a near-duplicate prompt instead of calling Gemini
+SEMANTIC_CACHE_INDEX_PATH = "caption_cache.faiss"
+SEMANTIC_CACHE_ENTRIES_PATH = "caption_cache.json"
+SEMANTIC_CACHE_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+PROMPT_LINE_PREFIX = "Prompt for generating this image:"
+semantic_cache = None  # {"model", "index", "entries"} once loaded
+
+
+def load_semantic_cache():
+    global semantic_cache
+    if semantic_cache is not None:
+        return
+    if faiss is None:
+        logger.info("faiss/sentence-transformers not installed, semantic caption cache disabled")
+        return
+    try:
+        model = SentenceTransformer(SEMANTIC_CACHE_MODEL)
+        index, entries = None, []
+        if os.path.exists(SEMANTIC_CACHE_INDEX_PATH) and os.path.exists(SEMANTIC_CACHE_ENTRIES_PATH):
+            index = faiss.read_index(SEMANTIC_CACHE_INDEX_PATH)
+            with open(SEMANTIC_CACHE_ENTRIES_PATH) as f:
+                entries = json.load(f)
+            if index.ntotal != len(entries):
+                logger.warning(
+                    "Semantic caption cache files are out of sync (%s vectors, %s entries), starting empty",
+                    index.ntotal, len(entries)
+                )
+                index, entries = None, []
+        if index is None:
+            # Inner product over normalized embeddings == cosine similarity
+            index = faiss.IndexFlatIP(model.get_sentence_embedding_dimension())
+        semantic_cache = {"model": model, "index": index, "entries": entries}
+        logger.info("Loaded semantic caption cache with %s entries", len(entries))
+    except Exception as e:
+        logger.error("Failed to load semantic caption cache, continuing without it: %s", e)
+
+
+# Returns (embedding, cached caption body or None); embedding is None when the cache is unavailable.
+# The body excludes the trailing prompt line, which the caller adds for the current row.
+async def lookup_semantic_cache(prompt: str):
+    if semantic_cache is None:
+        return None, None
+    try:
+        embedding = await asyncio.to_thread(
+            semantic_cache["model"].encode, [prompt], normalize_embeddings=True
+        )
+        embedding = embedding.astype("float32")
+        if semantic_cache["index"].ntotal == 0:
+            return embedding, None
+        scores, ids = semantic_cache["index"].search(embedding, 1)
+        if scores[0][0] < SEMANTIC_CACHE_THRESHOLD:
+            return embedding, None
+        entry = semantic_cache["entries"][ids[0][0]]
+        logger.debug("Semantic cache hit (similarity %.3f) for prompt: %.50s...", scores[0][0], entry["prompt"])
+        return embedding, entry["caption"].rsplit(PROMPT_LINE_PREFIX, 1)[0].rstrip()
+    except Exception as e:
+        logger.warning("Semantic caption cache lookup failed: %s", e)
+        return None, None
+
+
+# Add to the in-memory cache; written to disk once per run by save_semantic_cache
+def store_semantic_cache(embedding, prompt: str, caption: str):
+    try:
+        semantic_cache["index"].add(embedding)
+        semantic_cache["entries"].append({"prompt": prompt, "caption": caption})
+    except Exception as e:
+        logger.warning("Failed to update semantic caption cache: %s", e)
+
+
+# Persist the index and entries, each via a temp file + os.replace so a crash never leaves a partial file
+def save_semantic_cache():
+    if semantic_cache is None:
+        return
+    try:
+        faiss.write_index(semantic_cache["index"], SEMANTIC_CACHE_INDEX_PATH + ".tmp")
+        with open(SEMANTIC_CACHE_ENTRIES_PATH + ".tmp", "w") as f:
+            json.dump(semantic_cache["entries"], f)
+        os.replace(SEMANTIC_CACHE_INDEX_PATH + ".tmp", SEMANTIC_CACHE_INDEX_PATH)
+        os.replace(SEMANTIC_CACHE_ENTRIES_PATH + ".tmp", SEMANTIC_CACHE_ENTRIES_PATH)
+        logger.info("Saved semantic caption cache with %s entries", len(semantic_cache['entries']))
+    except Exception as e:
+        logger.warning("Failed to save semantic caption cache: %s", e)
+
+# State definition for LangGraph; nodes return only the keys they change
+@dataclass(slots=True)  # Slots: faster attribute access and no per-instance dict
+class WorkflowState:
+    rows: List[dict] = field(default_factory=list)
+    current_row_index: int = 0
+    caption: Optional[str] = None
+    post_id: Optional[str] = None  # Instagram
+    facebook_post_id: Optional[str] = None  # Facebook
+    # Nodes return only the ranges they add
+    ranges_to_clear: Annotated[List[str], operator.add] = field(default_factory=list)
+    error: Optional[str] = None
 
 # Node 1: Filter rows from Google Sheets
-def filter_rows(state: WorkflowState) -> WorkflowState:
+async def filter_rows(state: WorkflowState, config: RunnableConfig) -> dict:
     logger.info("Starting filter_rows node")
     try:
-        service = get_sheets_service()
-        range_name = f"{SHEET_NAME}!A1:DZ"
-        logger.info(f"Fetching rows from Google Sheet: {SPREADSHEET_ID}, range: {range_name}")
+        session = config["configurable"]["session"]
+        range_name = f"{SHEET_NAME}!A1:B"  # Only the prompt and image URL columns are used
+        logger.info("Fetching rows from Google Sheet: %s, range: %s", SPREADSHEET_ID, range_name)
         
-        # Add retry logic for transient errors like 503
-        max_retries = 5
-        for attempt in range(max_retries):
-            try:
-                result = service.spreadsheets().values().get(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=range_name,
-                    valueRenderOption="FORMATTED_VALUE",
-                    dateTimeRenderOption="FORMATTED_STRING"
-                ).execute()
-                break
-            except HttpError as e:
-                if e.resp.status in [429, 500, 503]:  # Retry on rate limits, internal errors, service unavailable
-                    logger.warning(f"Retry attempt {attempt + 1}/{max_retries} after error: {str(e)}")
-                    time.sleep(2 ** attempt)  # Exponential backoff
-                else:
-                    raise
-        else:
-            raise Exception("Max retries exceeded for Google Sheets API call")
+        response, body = await request_with_retry(
+            session, "GET",
+            f"{SHEETS_API_URL}/{SPREADSHEET_ID}/values/{quote(range_name, safe='')}",
+            params={
+                "majorDimension": "ROWS",
+                "valueRenderOption": "FORMATTED_VALUE",
+                "dateTimeRenderOption": "FORMATTED_STRING",
+                "fields": "values"  # Skip range/majorDimension in the response
+            },
+            headers=await get_sheets_headers()
+        )
+        raise_for_status(response, body)
+        result = orjson.loads(body)
         
         values = result.get("values", [])
         
         # Filter rows where columns A and B are not empty
-        filtered_rows = [
-            {"row_number": idx + 2, "prompt": row[0], "image_url": row[1] if len(row) > 1 else ""}
-            for idx, row in enumerate(values[1:])  # Skip header
-            if len(row) > 1 and row[0] and row[1]
-        ]
+        filtered_rows = list(
+            {"row_number": row_number, "prompt": row[PROMPT_COL], "image_url": row[IMAGE_URL_COL]}
+            for row_number, row in enumerate(itertools.islice(values, 1, None), start=2)  # Skip header
+            if len(row) > IMAGE_URL_COL and row[PROMPT_COL] and row[IMAGE_URL_COL]
+        )
         
-        state["rows"] = filtered_rows
-        state["current_row_index"] = 0
-        state["error"] = None
-        logger.info(f"Filtered {len(filtered_rows)} rows from Google Sheets: {[row['row_number'] for row in filtered_rows]}")
-        return state
-    except HttpError as e:
-        state["error"] = f"Error filtering rows: {str(e)}"
-        logger.error(state["error"])
-        return state
+        logger.info("Filtered %s rows from Google Sheets: %s", len(filtered_rows), [row['row_number'] for row in filtered_rows])
+        return {"rows": filtered_rows}
     except Exception as e:
-        state["error"] = f"Error filtering rows: {str(e)}"
-        logger.error(state["error"])
-        return state
+        error = f"Error filtering rows: {str(e)}"
+        logger.error("%s", error)
+        return {"error": error}
     finally:
         logger.info("Finished filter_rows node")
 
 # Node 2: Generate Instagram caption using Gemini AI
-def generate_caption(state: WorkflowState) -> WorkflowState:
-    logger.info(f"Starting generate_caption node for row index {state['current_row_index']}")
+async def generate_caption(state: WorkflowState) -> dict:
+    logger.debug("Starting generate_caption node for row index %s", state.current_row_index)
     
-    if state["error"]:
-        logger.warning(f"Skipping generate_caption due to existing error: {state['error']}")
-        return state
-
-    if state["current_row_index"] >= len(state["rows"]):
-        logger.info("No more rows to process in generate_caption")
-        state["error"] = "No more rows to process"
-        return state
+    if state.error:
+        logger.warning("Skipping generate_caption due to existing error: %s", state.error)
+        return {}
 
     try:
-        current_row = state["rows"][state["current_row_index"]]
+        current_row = state.rows[state.current_row_index]
         original_prompt = current_row["prompt"]
 
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash",
-            google_api_key=GEMINI_API_KEY
-        )
+        prompt_hash = hashlib.sha256(original_prompt.encode()).hexdigest()
+        cached_caption = get_exact_cached_caption(prompt_hash)
+        if cached_caption:
+            logger.debug("Reused exact-match cached caption for row %s", current_row["row_number"])
+            return {"caption": cached_caption}
+
+        embedding, cached_caption_body = await lookup_semantic_cache(original_prompt)
 
         # Step 1: Normalize prompt (detect language + translate if needed)
-        normalize_prompt = (
-            "Detect the language of the following text. "
-            "If it is not English, translate it into natural English. "
-            "Return ONLY the English version of the text.\n\n"
-            f"Text:\n{original_prompt}"
-        )
+        normalize_prompt = NORMALIZE_PROMPT_TEMPLATE.format(prompt=original_prompt)
 
-        logger.info("Normalizing (translating if needed) image prompt")
-        normalized_response = llm.invoke(normalize_prompt)
+        logger.debug("Normalizing (translating if needed) image prompt")
+        normalized_response = await LLM.ainvoke(normalize_prompt)
         english_prompt = normalized_response.content.strip()
 
+        if cached_caption_body:
+            # Near-duplicate prompt: reuse the cached caption, but stamp this row's English prompt
+            logger.debug("Reused cached caption for row %s", current_row["row_number"])
+            caption = f'{cached_caption_body}\n{PROMPT_LINE_PREFIX} "{english_prompt}"'
+            return {"caption": caption}
+
         # Step 2: Generate Instagram caption including the prompt
-        caption_prompt = (
-            "Create a single Instagram caption (max 150 words) for an AI-generated image.\n\n"
-            "Rules:\n"
-            "- The caption should feel modern, creative, and AI-art focused\n"
-            "- Include relevant trending hashtags\n"
-            "- Do NOT provide multiple options\n"
-            "- After the caption, add a new line exactly in this format:\n"
-            'Prompt for generating this image: "<PROMPT>"\n\n'
-            f'Use this prompt:\n"{english_prompt}"'
-        )
+        caption_prompt = CAPTION_PROMPT_TEMPLATE.format(prompt=english_prompt)
 
-        logger.info("Generating final Instagram caption with embedded prompt")
-        caption_response = llm.invoke(caption_prompt)
+        logger.debug("Generating final Instagram caption with embedded prompt")
+        caption_response = await LLM.ainvoke(caption_prompt)
 
-        state["caption"] = caption_response.content.strip()
-        state["error"] = None
+        caption = caption_response.content.strip()
+        store_exact_cached_caption(prompt_hash, caption)
+        if embedding is not None:
+            store_semantic_cache(embedding, original_prompt, caption)
 
-        logger.info(
-            f"Generated caption for row {current_row['row_number']}: "
-            f"{state['caption'][:80]}..."
-        )
+        logger.debug("Generated caption for row %s: %.80s...", current_row["row_number"], caption)
 
-        return state
+        return {"caption": caption}
 
     except Exception as e:
-        state["error"] = f"Error generating caption: {str(e)}"
-        logger.error(state["error"])
-        return state
+        error = f"Error generating caption: {str(e)}"
+        logger.error("%s", error)
+        return {"error": error}
 
     finally:
-        logger.info("Finished generate_caption node")
-
-# Node 3: Create Instagram post with retry logic
-def create_instagram_post(state: WorkflowState) -> WorkflowState:
-    logger.info(f"Starting create_instagram_post node for row index {state['current_row_index']}")
-    if state["error"]:
-        logger.warning(f"Skipping create_instagram_post due to existing error: {state['error']}")
-        return state
-    
-    if state["current_row_index"] >= len(state["rows"]):
-        logger.info("No more rows to process in create_instagram_post")
-        state["error"] = "No more rows to process"
-        return state
-    
-    try:
-        current_row = state["rows"][state["current_row_index"]]
-        image_url = current_row["image_url"]
-        caption = state["caption"]
-        logger.info(f"Attempting to post to Instagram: image_url={image_url}, caption={caption[:50]}...")
-        
-        # Step 1: Create a media container
-        create_media_url = f"https://graph.instagram.com/v21.0/{INSTAGRAM_ACCOUNT_ID}/media"
-        payload = {
-            "image_url": image_url,
-            "caption": caption,
-            "access_token": INSTAGRAM_ACCESS_TOKEN
-        }
-        response = requests.post(create_media_url, data=payload, verify=True)
-        response.raise_for_status()
-        response_data = response.json()
-        media_id = response_data.get("id")
-        if not media_id:
-            raise ValueError(f"Failed to create media container: {response_data}")
-        logger.info(f"Created media container for row {current_row['row_number']}: media_id={media_id}")
-        
-        # Step 2: Publish the media with retries
-        publish_url = f"https://graph.instagram.com/v21.0/{INSTAGRAM_ACCOUNT_ID}/media_publish"
-        publish_payload = {
-            "creation_id": media_id,
-            "access_token": INSTAGRAM_ACCESS_TOKEN
-        }
-        
-        max_retries = 5
-        for attempt in range(max_retries):
-            publish_response = requests.post(publish_url, data=publish_payload, verify=True)
-            if publish_response.status_code == 200:
-                publish_data = publish_response.json()
-                post_id = publish_data.get("id")
-                if post_id:
-                    state["post_id"] = post_id
-                    state["error"] = None
-                    logger.info(f"Posted to Instagram for row {current_row['row_number']}: post_id={post_id}")
-                    return state
-            else:
-                error_json = publish_response.json()
-                error_code = error_json.get("error", {}).get("code")
-                error_subcode = error_json.get("error", {}).get("error_subcode")
-                if error_code == 9007 and error_subcode == 2207027:
-                    wait_time = 2 ** attempt
-                    logger.warning(f"Media not ready (attempt {attempt+1}/{max_retries}), retrying in {wait_time}s...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    publish_response.raise_for_status()
-        
-        raise Exception(f"Failed to publish media after {max_retries} attempts: {publish_response.text}")
-    
-    except Exception as e:
-        state["error"] = f"Error creating Instagram post: {str(e)}"
-        logger.error(state["error"])
-        return state
-    finally:
-        logger.info("Finished create_instagram_post node")
-
-# Node 3b: Create Facebook post (COMMENTED OUT - SKIPPED)
-"""
-def create_facebook_post(state: WorkflowState) -> WorkflowState:
-    logger.info(f"Starting create_facebook_post node for row index {state['current_row_index']}")
-    if state["error"]:
-        logger.warning(f"Skipping create_facebook_post due to existing error: {state['error']}")
-        return state
-    
-    if state["current_row_index"] >= len(state["rows"]):
-        logger.info("No more rows to process in create_facebook_post")
-        state["error"] = "No more rows to process"
-        return state
-    
-    try:
-        current_row = state["rows"][state["current_row_index"]]
-        image_url = current_row["image_url"]
-        caption = state["caption"]
-        logger.info(f"Attempting to post to Facebook: image_url={image_url}, caption={caption[:50]}...")
-        
-        # Facebook Graph API endpoint for posting photos to profile
-        facebook_url = f"https://graph.facebook.com/v21.0/me/photos"
-        payload = {
-            "url": image_url,
-            "caption": caption,
-            "access_token": FACEBOOK_ACCESS_TOKEN  # Your User Token
-        }
-        
-        response = requests.post(facebook_url, data=payload, verify=True)
-        response.raise_for_status()
-        response_data = response.json()
-        
-        post_id = response_data.get("id")
-        if not post_id:
-            raise ValueError(f"Failed to create Facebook post: {response_data}")
-        
-        state["facebook_post_id"] = post_id
-        state["error"] = None
-        logger.info(f"Posted to Facebook for row {current_row['row_number']}: post_id={post_id}")
-        return state
-    except requests.exceptions.HTTPError as e:
-        state["error"] = f"Error creating Facebook post: {str(e)}. Response: {e.response.text}"
-        logger.error(state["error"])
-        return state
-    except Exception as e:
-        state["error"] = f"Error creating Facebook post: {str(e)}"
-        logger.error(state["error"])
-        return state
-    finally:
-        logger.info("Finished create_facebook_post node")
-"""
-
-# Node 4: Clear row in Google Sheets
-def clear_row(state: WorkflowState) -> WorkflowState:
-    logger.info(f"Starting clear_row node for row index {state['current_row_index']}")
-    if state["current_row_index"] >= len(state["rows"]):
-        logger.info("No more rows to clear in clear_row")
-        state["error"] = "No more rows to process"
-        return state
-    
-    clear_success = False
+        logger.debug("Finished generate_caption node")
+
+# Post an image to Instagram, returning the published post id
+async def post_instagram(session: aiohttp.ClientSession, row_number: int, image_url: str, caption: str) -> str:
+    logger.debug("Attempting to post to Instagram: image_url=%s, caption=%.50s...", image_url, caption)
+
+    # Step 1: Create a media container
+    create_media_url = f"https://graph.instagram.com/v21.0/{INSTAGRAM_ACCOUNT_ID}/media"
+    payload = {"image_url": image_url, "caption": caption}
+    async with instagram_semaphore:
+        response, body = await request_with_retry(
+            session, "POST", create_media_url, data=payload, headers=INSTAGRAM_HEADERS
+        )
+    raise_for_status(response, body)
+    response_data = orjson.loads(body)
+    media_id = response_data.get("id")
+    if not media_id:
+        raise ValueError(f"Failed to create media container: {response_data}")
+    logger.debug("Created media container for row %s: media_id=%s", row_number, media_id)
+
+    # Step 2: Poll the container until Instagram has finished processing the image
+    status_url = f"https://graph.instagram.com/v21.0/{media_id}"
+    status_params = {"fields": "status_code"}
+
+    max_polls = 10
+    for poll in range(max_polls):
+        async with instagram_semaphore:
+            status_response, status_body = await request_with_retry(
+                session, "GET", status_url, params=status_params, headers=INSTAGRAM_HEADERS
+            )
+        raise_for_status(status_response, status_body)
+        status_code = orjson.loads(status_body).get("status_code")
+        if status_code == "FINISHED":
+            break
+        if status_code in ("ERROR", "EXPIRED"):
+            raise ValueError(f"Media container {media_id} failed with status {status_code}")
+        logger.debug("Media not ready (poll %s/%s, status=%s), checking again in 1s...", poll + 1, max_polls, status_code)
+        await asyncio.sleep(1)
+    else:
+        raise Exception(f"Media container {media_id} not ready after {max_polls} polls (status={status_code})")
+
+    # Step 3: Publish the media
+    publish_url = f"https://graph.instagram.com/v21.0/{INSTAGRAM_ACCOUNT_ID}/media_publish"
+    publish_payload = {"creation_id": media_id}
+    async with instagram_semaphore:
+        publish_response, publish_body = await request_with_retry(
+            session, "POST", publish_url, data=publish_payload, headers=INSTAGRAM_HEADERS
+        )
+    raise_for_status(publish_response, publish_body)
+    publish_data = orjson.loads(publish_body)
+    post_id = publish_data.get("id")
+    if not post_id:
+        raise ValueError(f"Failed to publish media: {publish_data}")
+    logger.info("Posted to Instagram for row %s: post_id=%s", row_number, post_id)
+    return post_id
+
+# Post an image to the Facebook profile, returning the post id
+async def post_facebook(session: aiohttp.ClientSession, row_number: int, image_url: str, caption: str) -> str:
+    logger.debug("Attempting to post to Facebook: image_url=%s, caption=%.50s...", image_url, caption)
+
+    # Facebook Graph API endpoint for posting photos to profile
+    facebook_url = f"https://graph.facebook.com/v21.0/me/photos"
+    payload = {"url": image_url, "caption": caption}
+
+    response, body = await request_with_retry(
+        session, "POST", facebook_url, data=payload, headers=FACEBOOK_HEADERS  # Your User Token
+    )
+    raise_for_status(response, body)
+    response_data = orjson.loads(body)
+
+    post_id = response_data.get("id")
+    if not post_id:
+        raise ValueError(f"Failed to create Facebook post: {response_data}")
+    logger.info("Posted to Facebook for row %s: post_id=%s", row_number, post_id)
+    return post_id
+
+# Node 3: Post to Instagram and (if enabled) Facebook concurrently
+async def create_social_posts(state: WorkflowState, config: RunnableConfig) -> dict:
+    logger.debug("Starting create_social_posts node for row index %s", state.current_row_index)
+    if state.error:
+        logger.warning("Skipping create_social_posts due to existing error: %s", state.error)
+        return {}
+
     try:
-        current_row = state["rows"][state["current_row_index"]]
+        session = config["configurable"]["session"]
+        current_row = state.rows[state.current_row_index]
         row_number = current_row["row_number"]
-        range_name = f"{SHEET_NAME}!A{row_number}:DZ{row_number}"
-        logger.info(f"Clearing row {row_number} in Google Sheet: {range_name}")
-        service = get_sheets_service()
-        
-        # Add retry logic for transient errors like 503
-        max_retries = 5
-        for attempt in range(max_retries):
-            try:
-                service.spreadsheets().values().clear(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=range_name
-                ).execute()
-                break
-            except HttpError as e:
-                if e.resp.status in [429, 500, 503]:
-                    logger.warning(f"Retry attempt {attempt + 1}/{max_retries} after error: {str(e)}")
-                    time.sleep(2 ** attempt)
-                else:
-                    raise
+        image_url = current_row["image_url"]
+        caption = state.caption
+
+        # Different hosts, so both posts go out at the same time
+        posts = [post_instagram(session, row_number, image_url, caption)]
+        if POST_TO_FACEBOOK:
+            posts.append(post_facebook(session, row_number, image_url, caption))
+        results = await asyncio.gather(*posts, return_exceptions=True)
+        ig_result = results[0]
+        fb_result = results[1] if POST_TO_FACEBOOK else None
+
+        update = {}
+        errors = []
+        if isinstance(ig_result, BaseException):
+            errors.append(f"Error creating Instagram post: {str(ig_result)}")
         else:
-            raise Exception("Max retries exceeded for Google Sheets API call")
-        
-        logger.info(f"Cleared row {row_number}")
-        clear_success = True
-    except HttpError as e:
-        state["error"] = f"Error clearing row: {str(e)}"
-        logger.error(state["error"])
-        clear_success = False
+            update["post_id"] = ig_result
+        if isinstance(fb_result, BaseException):
+            errors.append(f"Error creating Facebook post: {str(fb_result)}")
+        elif fb_result:
+            update["facebook_post_id"] = fb_result
+
+        if errors:
+            update["error"] = "; ".join(errors)
+            logger.error("%s", update["error"])
+        return update
     except Exception as e:
-        state["error"] = f"Error clearing row: {str(e)}"
-        logger.error(state["error"])
-        clear_success = False
-    
-    # Always proceed to next row after attempting clear (since posts succeeded)
-    state["current_row_index"] += 1
-    state["caption"] = None
-    state["post_id"] = None
-    state["facebook_post_id"] = None
-    if not clear_success:
-        logger.warning(f"Failed to clear row {current_row['row_number']}, but proceeding to next row to avoid re-processing.")
-    state["error"] = None  # Clear any error to allow proceeding
-    logger.info(f"Moved to next row index: {state['current_row_index']}")
-    return state
-
-# Node 4b: Skip failed row - delete it from sheet and move to next row
-def skip_row(state: WorkflowState) -> WorkflowState:
-    logger.info(f"Starting skip_row node for row index {state['current_row_index']}")
-    if state["current_row_index"] >= len(state["rows"]):
-        logger.info("No more rows in skip_row")
-        return state
-
-    current_row = state["rows"][state["current_row_index"]]
+        error = f"Error creating social posts: {str(e)}"
+        logger.error("%s", error)
+        return {"error": error}
+    finally:
+        logger.debug("Finished create_social_posts node")
+
+# Node 4: Queue row for clearing in Google Sheets (cleared in one batch at the end)
+async def clear_row(state: WorkflowState) -> dict:
+    logger.debug("Starting clear_row node for row index %s", state.current_row_index)
+    current_row = state.rows[state.current_row_index]
+    row_number = current_row["row_number"]
+    range_name = f"{SHEET_NAME}!A{row_number}:DZ{row_number}"
+    logger.debug("Queued row %s for clearing: %s", row_number, range_name)
+    return {"ranges_to_clear": [range_name]}
+
+# Node 4b: Skip failed row - queue it for deletion from sheet
+async def skip_row(state: WorkflowState) -> dict:
+    logger.debug("Starting skip_row node for row index %s", state.current_row_index)
+    current_row = state.rows[state.current_row_index]
     row_number = current_row["row_number"]
-    upload_error = state.get("error", "Unknown error")
+    upload_error = state.error or "Unknown error"
     logger.warning(
-        f"Skipping and deleting row {row_number} due to upload failure: {upload_error}"
+        "Skipping and deleting row %s due to upload failure: %s", row_number, upload_error
     )
 
-    try:
-        service = get_sheets_service()
-        range_name = f"{SHEET_NAME}!A{row_number}:DZ{row_number}"
-        max_retries = 5
-        for attempt in range(max_retries):
-            try:
-                service.spreadsheets().values().clear(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=range_name
-                ).execute()
-                logger.info(f"Deleted (cleared) failed row {row_number} from sheet")
-                break
-            except HttpError as e:
-                if e.resp.status in [429, 500, 503]:
-                    logger.warning(f"Retry attempt {attempt + 1}/{max_retries} after error: {str(e)}")
-                    time.sleep(2 ** attempt)
-                else:
-                    raise
-        else:
-            logger.error(f"Max retries exceeded while clearing failed row {row_number}")
-    except Exception as e:
-        logger.error(f"Failed to clear failed row {row_number}: {str(e)}")
-
-    # Advance to next row regardless
-    state["current_row_index"] += 1
-    state["caption"] = None
-    state["post_id"] = None
-    state["facebook_post_id"] = None
-    state["error"] = None
-    logger.info(f"Skipped row {row_number}, moved to next row index: {state['current_row_index']}")
-    return state
-
-# Conditional edge after Instagram post - MODIFIED: Go directly to clear_row
-def decide_after_instagram(state: WorkflowState) -> str:
-    if state.get("post_id") and not state.get("error"):
-        logger.info("Instagram post successful, proceeding to clear row (Facebook skipped)")
-        return "clear_row"  # Skip Facebook, go directly to clear_row
-    else:
-        logger.warning(f"Instagram post failed or error: {state.get('error')}, skipping this row")
-        return "skip_row"
+    range_name = f"{SHEET_NAME}!A{row_number}:DZ{row_number}"
+    logger.debug("Skipped row %s, queued for clearing: %s", row_number, range_name)
+    return {"ranges_to_clear": [range_name]}
 
-# REMOVED: Conditional edge after Facebook post (no longer needed)
-"""
-def decide_after_facebook(state: WorkflowState) -> str:
-    if state.get("facebook_post_id") and not state.get("error"):
-        logger.info("Facebook post successful, proceeding to clear row")
+# Conditional edge after posting
+def decide_after_posts(state: WorkflowState) -> str:
+    if state.post_id and not state.error:
+        logger.debug("Posts successful, proceeding to clear row")
+        return "clear_row"
+    elif state.post_id:
+        # Already live on Instagram; re-processing the row would post it there twice
+        logger.warning(
+            "Instagram post %s published but Facebook failed: %s, clearing row %s anyway",
+            state.post_id, state.error, state.rows[state.current_row_index]["row_number"]
+        )
         return "clear_row"
     else:
-        logger.warning(f"Facebook post failed or error: {state.get('error')}, ending workflow for this row")
-        return END
-"""
-
-# Conditional edge to handle errors or continue processing
-def decide_next_step(state: WorkflowState) -> str:
-    logger.info("Starting decide_next_step")
-    if state["current_row_index"] >= len(state["rows"]):
-        logger.info("No more rows to process, routing to END")
-        return END
-    logger.info(f"More rows to process, routing to generate_caption for row index {state['current_row_index']}")
-    return "generate_caption"
-
-# Build the LangGraph workflow
-workflow = StateGraph(WorkflowState)
+        logger.warning("Posting failed or error: %s, skipping this row", state.error)
+        return "skip_row"
 
-# Add nodes
-workflow.add_node("filter_rows", filter_rows)
-workflow.add_node("generate_caption", generate_caption)
-workflow.add_node("create_instagram_post", create_instagram_post)
-# workflow.add_node("create_facebook_post", create_facebook_post)  # Facebook node removed
-workflow.add_node("clear_row", clear_row)
-workflow.add_node("skip_row", skip_row)
+# Build the per-row LangGraph workflow (one invocation per sheet row)
+row_workflow = StateGraph(WorkflowState)
 
-# Define edges - MODIFIED to skip Facebook
-workflow.set_entry_point("filter_rows")
-workflow.add_edge("filter_rows", "generate_caption")
-workflow.add_edge("generate_caption", "create_instagram_post")
-workflow.add_conditional_edges(
-    "create_instagram_post",
-    decide_after_instagram,
-    {
-        "clear_row": "clear_row",  # Instagram success → clear row and continue
-        "skip_row": "skip_row"    # Instagram failure → skip/delete row and continue
-    }
-)
-# REMOVED: Facebook conditional edges
-"""
-workflow.add_conditional_edges(
-    "create_facebook_post",
-    decide_after_facebook,
-    {
-        "clear_row": "clear_row",
-        END: END
-    }
-)
-"""
-workflow.add_conditional_edges(
-    "clear_row",
-    decide_next_step,
-    {
-        "generate_caption": "generate_caption",
-        END: END
-    }
-)
-workflow.add_conditional_edges(
-    "skip_row",
-    decide_next_step,
+# Add nodes
+row_workflow.add_node("generate_caption", generate_caption)
+row_workflow.add_node("create_social_posts", create_social_posts)
+row_workflow.add_node("clear_row", clear_row)
+row_workflow.add_node("skip_row", skip_row)
+
+# Define edges
+row_workflow.set_entry_point("generate_caption")
+row_workflow.add_edge("generate_caption", "create_social_posts")
+row_workflow.add_conditional_edges(
+    "create_social_posts",
+    decide_after_posts,
     {
-        "generate_caption": "generate_caption",
-        END: END
+        "clear_row": "clear_row",  # Instagram post succeeded → clear row
+        "skip_row": "skip_row"    # Caption or Instagram post failed → skip/delete row
     }
 )
+row_workflow.add_edge("clear_row", END)
+row_workflow.add_edge("skip_row", END)
+
+row_graph = row_workflow.compile()
+
+# Node 5: Run the per-row workflow for every filtered row concurrently
+async def process_rows(state: WorkflowState, config: RunnableConfig) -> dict:
+    logger.info("Starting process_rows node for %s rows", len(state.rows))
+    if state.error:
+        logger.warning("Skipping process_rows due to existing error: %s", state.error)
+        return {}
+
+    await asyncio.to_thread(load_semantic_cache)
+    row_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ROWS)
+
+    async def process_row(index: int) -> dict:
+        async with row_semaphore:
+            row_state = WorkflowState(rows=state.rows, current_row_index=index)
+            return await row_graph.ainvoke(row_state, config=config)
+
+    results = await asyncio.gather(
+        *(process_row(index) for index in range(len(state.rows))),
+        return_exceptions=True
+    )
+    await asyncio.to_thread(save_semantic_cache)
+    ranges_to_clear = []
+    for row, result in zip(state.rows, results):
+        if isinstance(result, BaseException):  # Includes CancelledError from gather
+            logger.error("Unhandled error while processing row %s: %r", row["row_number"], result)
+        else:
+            ranges_to_clear.extend(result["ranges_to_clear"])
+
+    logger.info("Finished process_rows node")
+    return {"ranges_to_clear": ranges_to_clear}
+
+# Node 6: Clear all processed rows with batchClear (one API call per chunk instead of per row)
+async def batch_clear_rows(state: WorkflowState, config: RunnableConfig) -> dict:
+    logger.info("Starting batch_clear_rows node for %s ranges", len(state.ranges_to_clear))
+    if not state.ranges_to_clear:
+        logger.info("No rows to clear")
+        return {}
+
+    chunk_size = 100
+    update = {}
+    try:
+        session = config["configurable"]["session"]
+        for start in range(0, len(state.ranges_to_clear), chunk_size):
+            ranges = state.ranges_to_clear[start:start + chunk_size]
+            logger.info("Clearing %s rows in Google Sheet: %s", len(ranges), ranges)
+
+            response, body = await request_with_retry(
+                session, "POST",
+                f"{SHEETS_API_URL}/{SPREADSHEET_ID}/values:batchClear",
+                idempotent=True,  # Clearing the same ranges twice is harmless
+                json={"ranges": ranges},
+                headers=await get_sheets_headers()
+            )
+            raise_for_status(response, body)
+            logger.info("Cleared %s rows", len(ranges))
+    except Exception as e:
+        # Posts already went out, so report the failure but don't retry the rows
+        update["error"] = f"Error clearing rows: {str(e)}"
+        logger.error("%s", update["error"])
+        logger.warning("Rows that were not cleared may be re-processed on the next run.")
+    finally:
+        logger.info("Finished batch_clear_rows node")
+    return update
+
+# Build the top-level LangGraph workflow
+workflow = StateGraph(WorkflowState)
+
+workflow.add_node("filter_rows", filter_rows)
+workflow.add_node("process_rows", process_rows)
+workflow.add_node("batch_clear_rows", batch_clear_rows)
+
+workflow.set_entry_point("filter_rows")
+workflow.add_edge("filter_rows", "process_rows")
+workflow.add_edge("process_rows", "batch_clear_rows")
+workflow.add_edge("batch_clear_rows", END)
 
 # Compile and run the workflow
 graph = workflow.compile()
 
-def run_workflow():
-    logger.info("Starting workflow execution (Instagram only - Facebook skipped)")
-    initial_state = {
-        "rows": [],
-        "current_row_index": 0,
-        "caption": None,
-        "post_id": None,  # Instagram
-        "facebook_post_id": None,  # Facebook
-        "error": None
-    }
-    # Increase recursion limit to handle large datasets
-    for event in graph.stream(initial_state, config={"recursion_limit": 100}):
-        logger.info(f"Workflow state update:")
+async def run_workflow():
+    if POST_TO_FACEBOOK:
+        logger.info("Starting workflow execution (Instagram + Facebook)")
+    else:
+        logger.info("Starting workflow execution (Instagram only - Facebook skipped)")
+    initial_state = WorkflowState()
+    # One pooled HTTP session shared by every row
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+        ssl=SSL_CONTEXT
+    )
+    async with aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT) as session:
+        await graph.ainvoke(initial_state, config={"configurable": {"session": session}})
+    logger.info("Workflow execution finished")
 
 if __name__ == "__main__":
-    run_workflow()
\ No newline at end of file
+    asyncio.run(run_workflow())
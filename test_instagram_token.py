@@ -1,5 +1,6 @@
 import os
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,9 +10,13 @@ INSTAGRAM_ACCESS_TOKEN = os.getenv("INSTAGRAM_ACCESS_TOKEN")
 print("Testing Instagram Token...")
 print(f"Token (first 30 chars): {INSTAGRAM_ACCESS_TOKEN[:30]}...")
 
-# Test 1: Get Instagram account info
+# Test 1: Get Instagram account info / Test 2: Check permissions (independent, so run both at once)
 test_url = f"https://graph.instagram.com/v21.0/me?fields=id,username&access_token={INSTAGRAM_ACCESS_TOKEN}"
-response = requests.get(test_url)
+debug_url = f"https://graph.instagram.com/v21.0/debug_token?input_token={INSTAGRAM_ACCESS_TOKEN}&access_token={INSTAGRAM_ACCESS_TOKEN}"
+with ThreadPoolExecutor(2) as executor:
+    response_future = executor.submit(requests.get, test_url)
+    debug_future = executor.submit(requests.get, debug_url)
+    response, debug_response = response_future.result(), debug_future.result()
 
 if response.status_code == 200:
     data = response.json()
@@ -20,10 +25,6 @@ if response.status_code == 200:
     print(f"   Username: {data.get('username')}")
     print(f"   Account Type: {data.get('account_type', 'Not specified')}")
     
-    # Test 2: Check permissions
-    debug_url = f"https://graph.instagram.com/v21.0/debug_token?input_token={INSTAGRAM_ACCESS_TOKEN}&access_token={INSTAGRAM_ACCESS_TOKEN}"
-    debug_response = requests.get(debug_url)
-    
     if debug_response.status_code == 200:
         debug_data = debug_response.json()
         print(f"\n✅ Token Debug Info:")